@@ -44,25 +44,9 @@ fold_rules = FoldRules()
 fold_rules.setRules()
 
 
-# determine scope of folds (reaction sets that involve the fold)
-fold_dict = {}
-for fold in fold_rules.folds:
-    foldset = set([fold])
-    rns = fold_rules.rules[fold_rules.rules.fold_sets.apply(lambda x: foldset.issubset(x))].rn.unique().tolist()
-    fold_dict[fold] = rns
-    
-    
-# if the fold cover reactions that are not in the metabolic netowrk, do not use fold in iterative fold expansion code
-mrxns = metabolism.network.rn.unique().tolist()
-fold_remove = []
-for key,values in fold_dict.items():
-    if all([x not in mrxns for x in values]):
-        fold_remove.append(key)
-
-# remove all rules with folds that are not used in metabolic network or are erroneous
-fold_remove = fold_remove + ['PDBChainNotFound']
-# remove folds that are not included in metabolic network at all
-fold_rules.removeFolds(fold_remove)
+# remove folds whose scope (reactions of the rules containing the fold) has no reaction in the metabolic network,
+# together with the erroneous PDBChainNotFound fold
+fold_rules.pruneFolds(metabolism.network.rn.unique(),['PDBChainNotFound'])
 
 # define a random permutation on the folds
 folds = list(fold_rules.folds)
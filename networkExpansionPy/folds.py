@@ -1,7 +1,13 @@
 import numpy as np
 import pandas as pd
 import os
+import ray
+import struct
+import zlib
 from copy import copy, deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import coo_matrix, csr_matrix, csc_matrix
+from networkExpansionPy.lib import read_asset, worklist_propagate
 
 # define asset path
 asset_path,filename = os.path.split(os.path.abspath(__file__))
@@ -20,6 +26,15 @@ def folds2rn(rules_sub,foldSet):
     rns = rules_sub[feasible].rn.unique().tolist()
     return rns
 
+def to_fold_set(folds):
+    # make sure folds is of "set" type
+    if type(folds) != set:
+        if type(folds) != list:
+            folds = set([folds])
+        else:
+            folds = set(folds)
+    return folds
+
 
 class FoldRules:
     
@@ -29,47 +44,494 @@ class FoldRules:
         self.rn = None
         self.folds = None;
         
-    def copy(self):
-        return deepcopy(self)
+    def copy(self,deep=True):
+        # a shallow copy shares the rules table, which setRules and removeFolds replace rather than modify
+        if deep:
+            return deepcopy(self)
+        return copy(self)
         
     def setRules(self,path = '/ecode/ecod2rn.ec3.07Feb2021.csv'):
-        rules = pd.read_csv(asset_path + path)
+        rules = read_asset(asset_path + path)
         self.rns = rules.rn.unique().tolist()
         folds =  rules['rule'].apply(lambda x: set(x.split('_')))
         folds = [item for sublist in folds for item in sublist]
-        self.folds = list(set(folds))
+        # sorted rather than in set order, which changes with the hash seed
+        self.folds = sorted(set(folds))
         rules['fold_sets']= rules['rule'].apply(lambda x: set(x.split('_')))
         self.rules = rules
-        
+        self.compileRules()
+
+    def compileRules(self):
+        # inverted index of the rules table: a sparse rule x fold incidence matrix (one entry per distinct fold of a rule),
+        # the number of distinct folds of each rule, and the reaction of each rule as a code into reaction_index
+        rule_folds = self.rules['rule'].str.split('_').explode()
+        rule_folds = pd.DataFrame({'rule':np.repeat(np.arange(len(self.rules)),self.rules['rule'].str.count('_').to_numpy() + 1),
+                                   'fold':rule_folds.to_numpy()}).drop_duplicates()
+        self.fold_index = pd.Index(np.sort(rule_folds['fold'].unique()))
+        self.reaction_index = pd.Index(self.rules['rn'].unique())
+        self.rule_folds = coo_matrix((np.ones(len(rule_folds),dtype=int),(rule_folds['rule'].to_numpy(),self.fold_index.get_indexer(rule_folds['fold']))),
+                                     shape=(len(self.rules),len(self.fold_index))).tocsr()
+        self.rule_size = np.diff(self.rule_folds.indptr)
+        self.rule_rn = self.reaction_index.get_indexer(self.rules['rn'])
+        # fold x rule lookup of the rules containing each fold
+        self.fold_rules = self.rule_folds.T.tocsr()
+
+    def pruneFolds(self,rxns,folds_remove=None):
+        # remove folds without any reaction of rxns in their scope (plus folds_remove), together with every rule that
+        # contains one of them, in one pass; returns the removed folds
+        folds_remove = set() if folds_remove is None else to_fold_set(folds_remove)
+        in_network = self.reaction_index.isin(list(rxns))
+        used = np.asarray(self.fold_rules.dot(in_network[self.rule_rn].astype(int))).ravel() > 0
+        remove = self.fold_index[~used].tolist() + [f for f in folds_remove if f in self.fold_index]
+        fold_mask = np.zeros(len(self.fold_index),dtype=int)
+        fold_mask[self.fold_index.get_indexer(remove)] = 1
+        rulesRemoval = self.rule_folds.dot(fold_mask) > 0
+        self.rules = self.rules[~rulesRemoval]
+        remove = set(remove) | folds_remove
+        self.folds = [x for x in self.folds if x not in remove]
+        self.compileRules()
+        return sorted(remove)
+
+    def cursor(self,foldSet=None):
+        return FoldCursor(self,foldSet)
+
+    def fold_vector(self,foldSet):
+        # indicator vector of foldSet over fold_index (folds without rules are ignored)
+        idx = self.fold_index.get_indexer(list(to_fold_set(foldSet)))
+        v = np.zeros(len(self.fold_index),dtype=int)
+        v[idx[idx > -1]] = 1
+        return v
+
+    def rule_mask(self,foldSet):
+        # rules whose folds are all in foldSet
+        return self.rule_folds.dot(self.fold_vector(foldSet)) == self.rule_size
+
+    def reaction_mask(self,foldSet):
+        # reactions (over reaction_index) with at least one rule satisfied by foldSet
+        mask = np.zeros(len(self.reaction_index),dtype=bool)
+        mask[self.rule_rn[self.rule_mask(foldSet)]] = True
+        return mask
+
     def folds2reactions(self,foldSet):
-        # make sure foldSet is of "set" type
-        if type(foldSet) != set:
-            if type(foldSet) != list:
-                foldSet = set([foldSet])
-            else:
-                foldSet = set(foldSet)
-                
-        rns = folds2rn(self.rules,foldSet)
-        return rns
+        # reactions in the order of the first rule satisfied by foldSet, as folds2rn returns them
+        return self.reaction_index[pd.unique(self.rule_rn[self.rule_mask(foldSet)])].tolist()
     
     def removeFolds(self,folds_remove):
-        if type(folds_remove) != set:
-            if type(folds_remove) != list:
-                folds_remove = set([folds_remove])
-            else:
-                folds_remove = set(folds_remove)
-                
-        rulesRemoval = self.rules.fold_sets.apply(lambda x: folds_remove.issubset(x)) 
+        folds_remove = to_fold_set(folds_remove)
+        # remove the rules containing all of folds_remove
+        idx = self.fold_index.get_indexer(list(folds_remove))
+        if (idx > -1).all():
+            rulesRemoval = np.asarray(self.rule_folds[:,idx].sum(axis=1)).ravel() == len(folds_remove)
+        else:
+            rulesRemoval = np.zeros(len(self.rules),dtype=bool)
         self.rules = self.rules[~rulesRemoval]
         folds_remove_list = list(folds_remove)
         self.folds = [x for x in self.folds if x not in folds_remove_list]
+        self.compileRules()
     
+# a fold set that grows one fold at a time. it keeps the number of unmet folds of every rule, so adding a fold only
+# touches the rules containing it and returns the reactions it unlocks. the compiled rules are shared (a cursor is
+# unaffected by later removeFolds calls on its FoldRules), and fork copies only the per-rule counters
+class FoldCursor:
+
+    def __init__(self,foldRules,foldSet=None):
+        self.fold_index = foldRules.fold_index
+        self.reaction_index = foldRules.reaction_index
+        self.fold_rules = foldRules.fold_rules
+        self.rule_rn = foldRules.rule_rn
+        self.unmet = foldRules.rule_size.copy()
+        self.reaction_mask = np.zeros(len(self.reaction_index),dtype=bool)
+        self.fold_set = set()
+        if foldSet is not None:
+            for fold in to_fold_set(foldSet):
+                self.add_fold(fold)
+
+    def fork(self):
+        cursor = copy(self)
+        cursor.unmet = self.unmet.copy()
+        cursor.reaction_mask = self.reaction_mask.copy()
+        cursor.fold_set = set(self.fold_set)
+        return cursor
+
+    def add_fold(self,fold):
+        # reactions that become feasible when fold is added, in rule order
+        return self.reaction_index[self.add_fold_index(fold)].tolist()
+
+    def add_fold_index(self,fold):
+        # as add_fold, as positions in reaction_index
+        if fold in self.fold_set:
+            return np.array([],dtype=int)
+        self.fold_set.add(fold)
+        j = self.fold_index.get_indexer([fold])[0]
+        if j < 0:
+            return np.array([],dtype=int)
+        rules = self.fold_rules.indices[self.fold_rules.indptr[j]:self.fold_rules.indptr[j+1]]
+        self.unmet[rules] -= 1
+        rns = pd.unique(self.rule_rn[rules[self.unmet[rules] == 0]])
+        rns = rns[~self.reaction_mask[rns]]
+        self.reaction_mask[rns] = True
+        return rns
+
+    def reactions(self):
+        return self.reaction_index[self.reaction_mask].tolist()
+
 # define a function to run network expansion using a fold set
 # depends on metabolism object and foldRules objects
 def fold_expansion(metabolism,foldRules,fold_set,cpd_set,rxns_seed):
     rxns_feasible = foldRules.folds2reactions(fold_set)
     rxns_total = list(rxns_feasible) + list(rxns_seed)
-    m = metabolism.copy()
-    m.subnetwork(rxns_total)
-    cpds_ne,rxns_ne = m.expand(list(cpd_set))
-    return cpds_ne,rxns_ne,rxns_feasible
\ No newline at end of file
+    # restrict the shared network to the feasible reactions instead of copying it
+    cpds_ne,rxns_ne = metabolism.expand(list(cpd_set),algorithm='worklist',reactions=rxns_total)
+    return cpds_ne,rxns_ne,rxns_feasible
+
+# fixed point of fold_expansion for a fold set, kept in the index space of the compiled network: compounds x, fired
+# reactions y, reactions enabled by the folds (or already fired), and the unmet substrate counter of every reaction.
+# the gain of a candidate fold is found by propagating only from the reactions that the fold unlocks
+class FoldScope:
+
+    def __init__(self,metabolism,foldRules,cpd_set,rxn_set=[],fold_set=[]):
+        compiled = metabolism.compile()
+        self.compound_index = compiled.compound_index
+        self.idx_to_rid = compiled.idx_to_rid
+        self.R = csr_matrix(compiled.R)
+        self.Pt = csr_matrix(compiled.P.transpose())
+        self.A = csc_matrix(compiled.A)
+        # compiled reactions (both directions) of every reaction of the fold rules
+        codes = foldRules.reaction_index.get_indexer(compiled.reaction_index.get_level_values('rn'))
+        idx = np.nonzero(codes > -1)[0]
+        self.rule_reactions = csr_matrix((np.ones(len(idx),dtype=bool),(codes[idx],idx)),shape=(len(foldRules.reaction_index),self.R.shape[1]))
+
+        self.cursor = foldRules.cursor(fold_set)
+        self.x = compiled.compound_index.isin(list(cpd_set))
+        self.y = np.zeros(self.R.shape[1],dtype=bool)
+        idx = compiled.reaction_index.get_indexer(list(rxn_set)) if len(rxn_set) else np.array([],dtype=int)
+        self.y[idx[idx > -1]] = True
+        self.enabled = self.y.copy()
+        self.enabled[self.rule_reactions[np.nonzero(self.cursor.reaction_mask)[0]].indices] = True
+        self.unmet = compiled.b.toarray().ravel() - self.R.transpose().dot(self.x.astype(int))
+        # like netExp, nothing fires while no compound of x takes part in an enabled reaction
+        self.has_seed = (self.x & (self.A.dot(self.enabled.astype(int)) > 0)).any()
+
+    def propagate(self,new,x,y,unmet,enabled):
+        # fire the newly enabled reactions whose substrates are all present and propagate from their products
+        enabled[new] = True
+        if not self.has_seed:
+            if not (x[self.A[:,enabled].indices]).any():
+                return False
+            new = np.nonzero(enabled)[0]
+        fired = new[(unmet[new] == 0) & ~y[new]]
+        y[fired] = True
+        worklist_propagate(self.R,self.Pt,x,y,unmet,np.unique(self.Pt[fired].indices),enabled=enabled)
+        return True
+
+    def evaluate(self,fold):
+        # compounds and reactions (as indices) that fold would add, without changing the scope, and the reactions whose
+        # state the propagation read (the ones the fold unlocks and the consumers of its new compounds)
+        x,y,unmet,enabled = self.x.copy(),self.y.copy(),self.unmet.copy(),self.enabled.copy()
+        unlocked = self.rule_reactions[self.cursor.fork().add_fold_index(fold)].indices
+        self.propagate(unlocked[~self.enabled[unlocked]],x,y,unmet,enabled)
+        cpds = np.nonzero(x & ~self.x)[0]
+        rxns = np.nonzero(y & ~self.y)[0]
+        return cpds,rxns,np.union1d(unlocked,self.R[cpds].indices)
+
+    def gain(self,fold):
+        # new compounds and reactions if fold were added, without changing the scope
+        cpds,rxns,touched = self.evaluate(fold)
+        return self.labels(cpds,rxns)
+
+    def labels(self,cpds,rxns):
+        return self.compound_index[cpds].tolist(),[self.idx_to_rid[i] for i in rxns]
+
+    def add_fold_index(self,fold):
+        # add fold to the scope, returning the indices of its new compounds, fired reactions and enabled reactions
+        x,y,enabled = self.x.copy(),self.y.copy(),self.enabled.copy()
+        unlocked = self.rule_reactions[self.cursor.add_fold_index(fold)].indices
+        self.has_seed = self.propagate(unlocked[~self.enabled[unlocked]],self.x,self.y,self.unmet,self.enabled) or self.has_seed
+        return np.nonzero(self.x & ~x)[0],np.nonzero(self.y & ~y)[0],np.nonzero(self.enabled & ~enabled)[0]
+
+    def add_fold(self,fold):
+        # add fold to the scope, returning its new compounds and reactions
+        cpds,rxns,enabled = self.add_fold_index(fold)
+        return self.labels(cpds,rxns)
+
+# lazy greedy fold selection. the gain of a fold is not monotone in the fold set (a rule can need several folds, and a
+# reaction can need compounds that other folds make), so stale gains are not upper bounds. instead the gain of every
+# candidate is cached with the reactions its evaluation read, and after a fold is added only the candidates that
+# can gain from it are re-evaluated: those sharing a rule with it, and those that read a reaction it enabled or fed
+# with a new compound. for all others the union of the two expansions is closed, so the cached gain is exact once the
+# compounds and reactions the added fold reached are removed from it
+class LazyFoldSelector:
+
+    def __init__(self,metabolism,foldRules,seed_set):
+        self.scope = FoldScope(metabolism,foldRules,seed_set)
+        self.fold_index = foldRules.fold_index
+        # fold x fold: folds that appear together in a rule
+        self.shared_rules = foldRules.fold_rules.dot(foldRules.rule_folds).tocsr()
+        self.cache = {}
+        self.evaluations = 0
+
+    def select(self,folds,rng=None):
+        # the fold max_fold would choose from the gains of all folds, with its new compounds and reactions
+        for fold in folds:
+            if fold not in self.cache:
+                self.cache[fold] = self.scope.evaluate(fold)
+                self.evaluations = self.evaluations + 1
+        fold = max_fold(folds,[self.cache[f][:2] for f in folds],rng)
+        return (fold,) + tuple(self.scope.labels(*self.cache[fold][:2]))
+
+    def add_fold(self,fold):
+        has_seed = self.scope.has_seed
+        cpds,rxns,enabled = self.scope.add_fold_index(fold)
+        self.cache.pop(fold,None)
+        if has_seed != self.scope.has_seed:
+            self.cache = {}
+            return
+        new_cpd = np.zeros(len(self.scope.x),dtype=bool)
+        new_cpd[cpds] = True
+        new_rxn = np.zeros(len(self.scope.y),dtype=bool)
+        new_rxn[rxns] = True
+        new_enabled = np.zeros(len(self.scope.y),dtype=bool)
+        new_enabled[enabled] = True
+        # number of new substrates of each reaction
+        new_substrates = self.scope.R.transpose().dot(new_cpd.astype(int))
+        j = self.fold_index.get_indexer([fold])[0]
+        shared = set(self.fold_index[self.shared_rules[j].indices]) if j > -1 else set()
+        for f,(c,r,touched) in list(self.cache.items()):
+            stale = f in shared
+            if not stale:
+                # new substrates of read reactions, not counting the compounds the candidate reached itself
+                n = new_substrates[touched]
+                if n.any():
+                    overlap = c[new_cpd[c]]
+                    if len(overlap):
+                        n = n - np.bincount(np.searchsorted(touched,self.scope.R[overlap].indices),minlength=len(touched))
+                    stale = n.any()
+            if not stale:
+                stale = (new_enabled[touched] & ~np.isin(touched,r)).any()
+            if stale:
+                del self.cache[f]
+            else:
+                self.cache[f] = (c[~new_cpd[c]],r[~new_rxn[r]],touched)
+
+# new compounds and reactions of each candidate fold added to fold_set (the inner loop of the greedy fold trace). with
+# incremental, candidates are scored from the current fixed point (cpd_set,rxn_set) through FoldScope.gain
+def fold_gains(metabolism,foldRules,fold_set,cpd_set,rxn_set,folds,incremental=False):
+    if incremental:
+        scope = FoldScope(metabolism,foldRules,cpd_set,rxn_set,fold_set)
+        return [scope.gain(fold) for fold in folds]
+    gains = []
+    for fold in folds:
+        c,re,rf = fold_expansion(metabolism,foldRules,fold_set.union(set([fold])),cpd_set,rxn_set)
+        gains.append(([x for x in c if x not in cpd_set],[x for x in re if x not in rxn_set]))
+    return gains
+
+def split_folds(folds,n):
+    # n contiguous chunks of folds (keeping their order)
+    bounds = np.linspace(0,len(folds),min(n,len(folds))+1).astype(int)
+    return [folds[i:j] for i,j in zip(bounds[:-1],bounds[1:])]
+
+# executors score a list of candidate folds and return their gains in the same order. the network and fold rules are
+# handed to the workers once, when the executor is created
+class SerialFoldExecutor:
+
+    def __init__(self,metabolism,foldRules,incremental=False):
+        self.metabolism = metabolism
+        self.foldRules = foldRules
+        self.incremental = incremental
+
+    def evaluate(self,fold_set,cpd_set,rxn_set,folds):
+        return fold_gains(self.metabolism,self.foldRules,fold_set,cpd_set,rxn_set,folds,self.incremental)
+
+    def shutdown(self):
+        pass
+
+worker_state = {}
+
+def init_fold_worker(metabolism,foldRules):
+    worker_state['metabolism'] = metabolism
+    worker_state['foldRules'] = foldRules
+
+def fold_worker_gains(args):
+    return fold_gains(worker_state['metabolism'],worker_state['foldRules'],*args)
+
+class ProcessFoldExecutor:
+
+    def __init__(self,metabolism,foldRules,n_workers=None,chunks_per_worker=4,incremental=False):
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.chunks_per_worker = chunks_per_worker
+        self.incremental = incremental
+        self.pool = ProcessPoolExecutor(self.n_workers,initializer=init_fold_worker,initargs=(metabolism,foldRules))
+
+    def evaluate(self,fold_set,cpd_set,rxn_set,folds):
+        chunks = split_folds(folds,self.n_workers*self.chunks_per_worker)
+        results = self.pool.map(fold_worker_gains,[(fold_set,cpd_set,rxn_set,chunk,self.incremental) for chunk in chunks])
+        return [g for gains in results for g in gains]
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+class RayFoldExecutor:
+
+    def __init__(self,metabolism,foldRules,n_workers=None,chunks_per_worker=4,incremental=False):
+        # one actor per worker holds its own copy of the network and rules; starts a local ray instance if needed
+        if not ray.is_initialized():
+            ray.init()
+        self.n_workers = int(ray.available_resources().get('CPU',1)) if n_workers is None else n_workers
+        self.chunks_per_worker = chunks_per_worker
+        metabolism = ray.put(metabolism)
+        foldRules = ray.put(foldRules)
+        self.workers = [ray.remote(SerialFoldExecutor).remote(metabolism,foldRules,incremental) for i in range(self.n_workers)]
+
+    def evaluate(self,fold_set,cpd_set,rxn_set,folds):
+        chunks = split_folds(folds,self.n_workers*self.chunks_per_worker)
+        refs = [self.workers[i % self.n_workers].evaluate.remote(fold_set,cpd_set,rxn_set,chunk) for i,chunk in enumerate(chunks)]
+        return [g for gains in ray.get(refs) for g in gains]
+
+    def shutdown(self):
+        for worker in self.workers:
+            ray.kill(worker)
+
+def max_fold(folds,gains,rng=None):
+    # fold with the most new reactions, then the most new compounds; remaining ties go to the first fold in folds
+    # (or a random one if rng, a random.Random, is given)
+    n_rn = np.array([len(g[1]) for g in gains])
+    n_cpd = np.array([len(g[0]) for g in gains])
+    best = np.nonzero(n_rn == n_rn.max())[0]
+    best = best[n_cpd[best] == n_cpd[best].max()]
+    if rng is not None:
+        return folds[rng.choice(best.tolist())]
+    return folds[best[0]]
+
+# fold trace checkpoints: one appended record per iteration, a (payload length, crc32) header followed by the
+# zlib compressed record. iteration 0 holds the seed compounds
+checkpoint_header = struct.Struct('<II')
+
+def write_fold_checkpoint(f,iteration,fold,cpds,rxns):
+    record = '\x1e'.join([str(iteration),fold,'\x1f'.join(cpds),'\x1f'.join(rn + '\x1d' + d for rn,d in rxns)])
+    payload = zlib.compress(record.encode('utf-8'))
+    f.write(checkpoint_header.pack(len(payload),zlib.crc32(payload)) + payload)
+    f.flush()
+    os.fsync(f.fileno())
+
+def read_fold_checkpoint(path):
+    # returns the (iteration, fold, cpds, rxns) records and the byte offset after the last complete record;
+    # a partially written last record (job killed during the write) is ignored
+    with open(path,'rb') as f:
+        data = f.read()
+    records = []
+    end = 0
+    while end + checkpoint_header.size <= len(data):
+        n,crc = checkpoint_header.unpack_from(data,end)
+        payload = data[end+checkpoint_header.size:end+checkpoint_header.size+n]
+        if len(payload) < n or zlib.crc32(payload) != crc:
+            break
+        iteration,fold,cpds,rxns = zlib.decompress(payload).decode('utf-8').split('\x1e')
+        cpds = cpds.split('\x1f') if cpds else []
+        rxns = [tuple(r.split('\x1d')) for r in rxns.split('\x1f')] if rxns else []
+        records.append((int(iteration),fold,cpds,rxns))
+        end = end + checkpoint_header.size + n
+    return records,end
+
+def load_fold_trace(path):
+    # fold, compound and reaction order tables of a (possibly unfinished) checkpointed trace
+    records,end = read_fold_checkpoint(path)
+    fold_df = pd.DataFrame({'iteration': [r[0] for r in records[1:]], 'fold': [r[1] for r in records[1:]]})
+    cpd_df = pd.DataFrame({'cid': [c for r in records for c in r[2]], 'iteration': [r[0] for r in records for c in r[2]]})
+    rxn_df = pd.DataFrame({'rn': [x for r in records for x in r[3]], 'iteration': [r[0] for r in records for x in r[3]]})
+    return fold_df,cpd_df,rxn_df
+
+def optimal_fold_trace(metabolism,foldRules,seed_set,folds=None,executor='serial',n_workers=None,rng=None,callback=None,incremental=False,lazy=False,checkpoint=None,resume=False):
+    # greedy fold trace: at every iteration add the fold whose expansion gives the most new reactions (then compounds),
+    # until no fold adds anything or all folds are used. executor is 'serial', 'process', 'ray' or an executor object,
+    # and incremental scores candidates by propagating from the current fixed point (see FoldScope). lazy only
+    # re-scores the candidates the last fold can affect (see LazyFoldSelector), in this process, so it only takes the
+    # 'serial' executor (and is always incremental).
+    # checkpoint is a file every iteration is appended to; with resume the trace continues from its last complete record
+    # returns the fold, compound and reaction order tables; callback(fold_df,cpd_df,rxn_df) is called after every iteration
+    if lazy and not (isinstance(executor,str) and executor == 'serial' and n_workers is None):
+        raise ValueError("lazy fold selection runs in this process and cannot be combined with an executor other than 'serial' or n_workers")
+    folds = list(foldRules.folds) if folds is None else list(folds)
+    metabolism.compile()
+    # executors created here are also shut down here
+    owned = isinstance(executor,str)
+    if lazy:
+        selector = LazyFoldSelector(metabolism,foldRules,seed_set)
+        executor = SerialFoldExecutor(metabolism,foldRules)
+    elif executor == 'serial':
+        executor = SerialFoldExecutor(metabolism,foldRules,incremental=incremental)
+    elif executor == 'process':
+        executor = ProcessFoldExecutor(metabolism,foldRules,n_workers,incremental=incremental)
+    elif executor == 'ray':
+        executor = RayFoldExecutor(metabolism,foldRules,n_workers,incremental=incremental)
+
+    fold_set = set()
+    cpd_set = set(seed_set)
+    rxn_set = set()
+    iteration = 0
+    fold_order = {'iteration': [], 'fold': []}
+    cpds_iteration = {'cid': list(seed_set), 'iteration': [iteration for x in seed_set]}
+    rxns_iteration = {'rn': [], 'iteration': []}
+    folds_remain = folds
+    finished = False
+    ckpt = None
+    try:
+        if checkpoint is not None:
+            records = []
+            if resume and os.path.exists(checkpoint):
+                records,end = read_fold_checkpoint(checkpoint)
+                # drop a partially written last record before appending
+                os.truncate(checkpoint,end)
+            if len(records) > 0 and set(records[0][2]) != set(seed_set):
+                raise ValueError('checkpoint ' + checkpoint + ' was written for a different seed set')
+            ckpt = open(checkpoint,'ab' if len(records) > 0 else 'wb')
+            if len(records) == 0:
+                write_fold_checkpoint(ckpt,iteration,'',list(seed_set),[])
+            # replay the checkpointed iterations
+            for iteration,fold,cpd_new,rn_new in records[1:]:
+                if lazy:
+                    selector.add_fold(fold)
+                cpds_iteration['cid'] += cpd_new
+                cpds_iteration['iteration'] += [iteration for x in cpd_new]
+                rxns_iteration['rn'] += rn_new
+                rxns_iteration['iteration'] += [iteration for x in rn_new]
+                cpd_set = cpd_set.union(cpd_new)
+                rxn_set = rxn_set.union(rn_new)
+                fold_set = fold_set.union(set([fold]))
+                fold_order['fold'].append(fold)
+                fold_order['iteration'].append(iteration)
+                finished = (len(cpd_new) + len(rn_new)) < 1
+            folds_remain = [x for x in folds_remain if x not in fold_set]
+
+        while len(folds_remain) > 0 and not finished:
+            iteration = iteration + 1
+            if lazy:
+                fold,cpd_new,rn_new = selector.select(folds_remain,rng)
+                selector.add_fold(fold)
+            else:
+                gains = executor.evaluate(fold_set,cpd_set,rxn_set,folds_remain)
+                fold = max_fold(folds_remain,gains,rng)
+                cpd_new,rn_new = gains[folds_remain.index(fold)]
+            if ckpt is not None:
+                write_fold_checkpoint(ckpt,iteration,fold,cpd_new,rn_new)
+
+            cpds_iteration['cid'] += cpd_new
+            cpds_iteration['iteration'] += [iteration for x in cpd_new]
+            rxns_iteration['rn'] += rn_new
+            rxns_iteration['iteration'] += [iteration for x in rn_new]
+            cpd_set = cpd_set.union(cpd_new)
+            rxn_set = rxn_set.union(rn_new)
+            fold_set = fold_set.union(set([fold]))
+            fold_order['fold'].append(fold)
+            fold_order['iteration'].append(iteration)
+            folds_remain = [f for f in folds_remain if f != fold]
+
+            if callback is not None:
+                callback(pd.DataFrame(fold_order),pd.DataFrame(cpds_iteration),pd.DataFrame(rxns_iteration))
+            # stop if the best fold adds nothing
+            finished = (len(cpd_new) + len(rn_new)) < 1
+    finally:
+        if ckpt is not None:
+            ckpt.close()
+        if owned:
+            executor.shutdown()
+    return pd.DataFrame(fold_order),pd.DataFrame(cpds_iteration),pd.DataFrame(rxns_iteration)
@@ -1,16 +1,90 @@
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, csc_matrix, coo_matrix, hstack
 import numpy as np
 import pandas as pd
 import ray
 from random import sample
 import os
 import json
+import re
+from array import array
+import hashlib
+import shutil
+import tempfile
+import time
 from copy import copy, deepcopy
 
 # define asset path
 asset_path,filename = os.path.split(os.path.abspath(__file__))
 asset_path = asset_path + '/assets'
 
+# define parsed asset cache path
+cache_path = os.environ.get('NETWORKEXPANSIONPY_CACHE',os.path.join(os.path.expanduser('~'),'.cache','networkExpansionPy'))
+
+def read_asset(path,categorical=False,**kwargs):
+    # read a csv asset through a binary cache of typed column arrays, keyed by the source file's path, size and mtime
+    # (so editing the file invalidates it) and memory-mapped on load; falls back to pd.read_csv if it cannot be used.
+    # with categorical, string columns are returned as categoricals built from the cached codes
+    stat = os.stat(path)
+    key = repr((os.path.abspath(path),stat.st_size,stat.st_mtime_ns,sorted(kwargs.items())))
+    cache_dir = os.path.join(cache_path,hashlib.md5(key.encode()).hexdigest())
+    if os.path.isdir(cache_dir):
+        try:
+            return load_cached_table(cache_dir,categorical)
+        except (OSError,ValueError,KeyError):
+            pass
+    df = pd.read_csv(path,**kwargs)
+    try:
+        save_cached_table(df,cache_dir)
+        # return the same column types as a cache hit
+        return load_cached_table(cache_dir,categorical)
+    except (OSError,TypeError,ValueError,KeyError):
+        return df
+
+def save_cached_table(df,cache_dir):
+    # numeric columns are saved as .npy arrays, string columns as int32 codes into an array of unique values
+    os.makedirs(cache_path,exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_path)
+    meta = []
+    for i,column in enumerate(df.columns):
+        values = df[column]
+        if pd.api.types.is_numeric_dtype(values.dtype):
+            np.save(os.path.join(tmp,str(i) + '.npy'),values.to_numpy())
+            kind = 'values'
+        else:
+            codes,categories = pd.factorize(values)
+            if not all(isinstance(c,str) for c in categories):
+                shutil.rmtree(tmp,ignore_errors=True)
+                raise TypeError('only string columns can be stored as categories')
+            np.save(os.path.join(tmp,str(i) + '.npy'),codes.astype(np.int32))
+            np.save(os.path.join(tmp,str(i) + '.categories.npy'),np.array(categories,dtype=str))
+            kind = 'categories'
+        meta.append({'name':column,'kind':kind,'dtype':str(values.dtype)})
+    with open(os.path.join(tmp,'meta.json'),'w') as f:
+        json.dump(meta,f)
+    try:
+        os.rename(tmp,cache_dir)
+    except OSError:
+        # another process built the same cache entry first
+        shutil.rmtree(tmp,ignore_errors=True)
+
+def load_cached_table(cache_dir,categorical=False):
+    with open(os.path.join(cache_dir,'meta.json')) as f:
+        meta = json.load(f)
+    columns = {}
+    for i,column in enumerate(meta):
+        values = np.load(os.path.join(cache_dir,str(i) + '.npy'),mmap_mode='c')
+        if column['kind'] == 'categories':
+            categories = np.load(os.path.join(cache_dir,str(i) + '.categories.npy'),mmap_mode='c').astype(object)
+            if categorical:
+                # the strings are not materialized per row
+                columns[column['name']] = pd.Categorical.from_codes(values,categories=categories)
+                continue
+            codes = values
+            values = np.full(len(codes),np.nan,dtype=object)
+            values[codes > -1] = categories[codes[codes > -1]]
+        columns[column['name']] = pd.Series(values,dtype=column['dtype'])
+    return pd.DataFrame(columns)
+
 def netExp(R,P,x,b):
     k = np.sum(x);
     k0 = 0;
@@ -47,8 +121,171 @@ def netExp_cr(R,P,x,b):
         l = np.sum(y)
     return x,y
 
+# propagate an expansion state (compounds x, fired reactions y and the number of unmet substrates of each reaction)
+# from a frontier of newly reached compounds, visiting only the reactions that consume them.
+# enabled optionally masks the reactions that are allowed to fire, and levels = (compound_iter,reaction_iter)
+# optionally records the netExp iteration at which each compound/reaction is first reached
+def worklist_propagate(R,Pt,x,y,unmet,frontier,enabled=None,levels=None,iteration=1):
+    frontier = frontier[~x[frontier]]
+    while len(frontier) > 0:
+        x[frontier] = True
+        if levels is not None:
+            levels[0][frontier] = iteration
+        # decrement the counters of reactions consuming the new compounds
+        consumers = R[frontier].indices
+        np.subtract.at(unmet,consumers,1)
+        touched = np.unique(consumers)
+        fired = touched[(unmet[touched] == 0) & ~y[touched]]
+        if enabled is not None:
+            fired = fired[enabled[fired]]
+        y[fired] = True
+        iteration = iteration + 1
+        if levels is not None:
+            levels[1][fired] = iteration
+        # products of the newly fired reactions that have not been reached yet
+        frontier = np.unique(Pt[fired].indices)
+        frontier = frontier[~x[frontier]]
+    return x,y
+
+# first-appearance network expansion: returns the iteration at which each compound first appears and each reaction
+# first fires in netExp (seeds are at iteration 0, -1 if never reached), along with the unmet substrate counters
+def netExp_levels(R,P,x,b):
+    n_compounds,n_reactions = R.shape
+    x = x.toarray().ravel() > 0
+    compound_iter = np.full(n_compounds,-1)
+    reaction_iter = np.full(n_reactions,-1)
+    compound_iter[x] = 0
+    R = csr_matrix(R)
+    Pt = csr_matrix(P.transpose())
+    unmet = b.toarray().ravel() - R.transpose().dot(x.astype('int'))
+    if x.sum() == 0:
+        return compound_iter,reaction_iter,unmet
+
+    y = unmet == 0
+    reaction_iter[y] = 1
+    frontier = np.unique(Pt[np.nonzero(y)[0]].indices)
+    worklist_propagate(R,Pt,x,y,unmet,frontier,levels=(compound_iter,reaction_iter))
+    return compound_iter,reaction_iter,unmet
+
+# event-driven network expansion: keep a counter of unmet substrates for each reaction, and for each newly added compound
+# only visit the reactions that consume it, so every edge of the network is touched at most once
+def netExp_worklist(R,P,x,b):
+    n_compounds,n_reactions = R.shape
+    x = x.toarray().ravel() > 0
+    if x.sum() == 0:
+        # mirror netExp, which does not fire any reactions when no seed is in the network
+        return csr_matrix(x.astype('int')).transpose(),csr_matrix((n_reactions,1),dtype='int')
+
+    R = csr_matrix(R)
+    Pt = csr_matrix(P.transpose())
+    unmet = b.toarray().ravel() - R.transpose().dot(x.astype('int'))
+    y = unmet == 0
+    frontier = np.unique(Pt[np.nonzero(y)[0]].indices)
+    x,y = worklist_propagate(R,Pt,x,y,unmet,frontier)
+
+    x = csr_matrix(x.astype('int')).transpose()
+    y = csr_matrix(y.astype('int')).transpose()
+    return x,y
+
+# warm-started network expansion: x holds the compounds of a prior expansion (expansion is monotone, so the prior is a
+# lower bound of the new scope). the frontier is seeded with the unreached products of every fireable
+# reaction, which is correct for any prior. new_reactions optionally restricts the frontier to the given reaction
+# indices, which is only valid when the prior is a fixed point
+def netExp_warmstart(R,P,x,b,new_reactions=None):
+    n_compounds,n_reactions = R.shape
+    x = x.toarray().ravel() > 0
+    if x.sum() == 0:
+        return csr_matrix(x.astype('int')).transpose(),csr_matrix((n_reactions,1),dtype='int')
+
+    R = csr_matrix(R)
+    Pt = csr_matrix(P.transpose())
+    unmet = b.toarray().ravel() - R.transpose().dot(x.astype('int'))
+    y = unmet == 0
+    if new_reactions is None:
+        delta = np.nonzero(y)[0]
+    else:
+        delta = np.asarray(new_reactions,dtype=int)
+        delta = delta[y[delta]]
+    frontier = np.unique(Pt[delta].indices)
+    x,y = worklist_propagate(R,Pt,x,y,unmet,frontier)
+
+    x = csr_matrix(x.astype('int')).transpose()
+    y = csr_matrix(y.astype('int')).transpose()
+    return x,y
+
+def pack_bits(M,n_bits):
+    # pack each row of a sparse (rows x n_bits) incidence matrix into uint64 words, keeping only the non-empty words
+    # returns the row, word index and bit mask of every non-empty word
+    M = M.tocoo()
+    n_words = (n_bits + 63) // 64
+    cols = M.col.astype(np.uint64)
+    keys = M.row.astype(np.int64)*n_words + (cols >> np.uint64(6)).astype(np.int64)
+    keys,inverse = np.unique(keys,return_inverse=True)
+    masks = np.zeros(len(keys),dtype=np.uint64)
+    np.bitwise_or.at(masks,inverse,np.uint64(1) << (cols & np.uint64(63)))
+    return keys // n_words,keys % n_words,masks
 
-def netExp_trace(R,P,x,b):
+def unpack_bits(words,n_bits):
+    idx = np.arange(n_bits,dtype=np.uint64)
+    return ((words[(idx >> np.uint64(6)).astype(np.intp)] >> (idx & np.uint64(63))) & np.uint64(1)).astype(bool)
+
+# bit-packed network expansion: compound state and reaction substrate/product masks are stored as uint64 words,
+# reactions fire when (x & substrates) == substrates for every word, and convergence is detected by comparing words
+def netExp_bits(R,P,x,b):
+    n_compounds,n_reactions = R.shape
+    if x.sum() == 0:
+        return x,csr_matrix((n_reactions,1),dtype='int')
+
+    r_rows,r_words,r_masks = pack_bits(csr_matrix(R).transpose(),n_compounds)
+    p_rows,p_words,p_masks = pack_bits(csr_matrix(P).transpose(),n_compounds)
+    x_words = np.zeros((n_compounds + 63) // 64,dtype=np.uint64)
+    _,words,masks = pack_bits(csr_matrix(x).transpose(),n_compounds)
+    x_words[words] = masks
+    while True:
+        unmet = (x_words[r_words] & r_masks) != r_masks
+        y = np.bincount(r_rows[unmet],minlength=n_reactions) == 0
+        fired = y[p_rows]
+        x_n = x_words.copy()
+        np.bitwise_or.at(x_n,p_words[fired],p_masks[fired])
+        if np.array_equal(x_n,x_words):
+            break
+        x_words = x_n
+
+    x = csr_matrix(unpack_bits(x_words,n_compounds).astype('int')).transpose()
+    y = csr_matrix(y.astype('int')).transpose()
+    return x,y
+
+
+# network expansion for many seed sets at once: X is a compounds x seed sets matrix, and columns are dropped from the
+# active set as soon as they reach their fixed point. enabled optionally gives a reactions x seed sets mask of the
+# reactions that may fire in each column
+def netExp_many(R,P,X,b,enabled=None):
+    X = np.asarray(X.toarray() if hasattr(X,'toarray') else X) > 0
+    n_reactions = R.shape[1]
+    b = np.asarray(b.toarray()).ravel()
+    RT = csr_matrix(R.transpose(),dtype=np.int32)
+    P = csr_matrix(P,dtype=np.int32)
+    Y = np.zeros([n_reactions,X.shape[1]],dtype=bool)
+    # like netExp, seed sets without any compound in the network do not fire any reactions
+    active = np.nonzero(X.any(axis=0))[0]
+    while len(active) > 0:
+        x = X[:,active]
+        y = RT.dot(x.astype(np.int32)) == b[:,None]
+        if enabled is not None:
+            y = y & enabled[:,active]
+        x_n = (P.dot(y.astype(np.int32)) > 0) | x
+        Y[:,active] = y
+        X[:,active] = x_n
+        active = active[(x_n != x).any(axis=0)]
+    return csc_matrix(X),csc_matrix(Y)
+
+
+def netExp_trace(R,P,x,b,compact=False):
+    # compact traces only keep the iteration at which each compound first appears and each reaction first fires
+    # (-1 if never), instead of the full compound and reaction vectors of every iteration
+    if compact:
+        compound_iter,reaction_iter,unmet = netExp_levels(R,P,x,b)
+        return compound_iter,reaction_iter
     
     X = []
     Y = []
@@ -84,6 +321,29 @@ def parse_reaction_trace(reaction_trace,network):
     rxns_list = pd.concat(rxns_list,axis=0)
     return rxns_list
 
+def trace_labels(network,idx):
+    # network is either the pivot table used to build R and P, or an index to id dict (idx_to_rid/idx_to_cid)
+    if isinstance(network,dict):
+        return [network[i] for i in idx]
+    return list(network.columns[idx])
+
+def parse_reaction_iter(reaction_iter,network):
+    # convert a compact reaction trace into a table of the iteration at which each reaction first fires
+    idx = np.nonzero(reaction_iter > 0)[0]
+    rxns = pd.DataFrame(trace_labels(network,idx),columns = ['rn','direction'])
+    rxns['iter'] = reaction_iter[idx]
+    return rxns
+
+def parse_compound_iter(compound_iter,network):
+    # convert a compact compound trace into a table of the iteration at which each compound first appears
+    idx = np.nonzero(compound_iter > -1)[0]
+    if isinstance(network,dict):
+        cpds = [network[i] for i in idx]
+    else:
+        cpds = list(network.index[idx])
+    cpds = pd.DataFrame({'cid':cpds,'iter':compound_iter[idx]})
+    return cpds
+
 
 def isRxnCoenzymeCoupled(rxn,cosubstrate,coproduct):
     g = rxn[rxn.cid.isin([cosubstrate,coproduct])]
@@ -93,38 +353,459 @@ def isRxnCoenzymeCoupled(rxn,cosubstrate,coproduct):
             out = True
     return out
 
-def load_ecg_network(ecg):
-    network_list = []
-    consistent_rids = []
-    for rid,v in ecg["reactions"].items():
+def iter_ecg_reactions(f,chunk_size=1<<20):
+    # stream the (rid, reaction) items of the top-level "reactions" object of an ecg json file, decoding one reaction
+    # at a time so that only a chunk of the file and a single reaction are held in memory
+    decoder = json.JSONDecoder()
+    string_end = re.compile(r'["\\]')
+    structure = re.compile(r'["{}\[\]]')
+    scalar_end = re.compile(r'[\s,:}\]]')
+    whitespace = re.compile(r'[ \t\n\r]*')
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf,pos,eof
+        chunk = f.read(chunk_size)
+        buf = buf[pos:] + chunk
+        pos = 0
+        eof = len(chunk) == 0
+        return not eof
+
+    def peek():
+        # next non-whitespace character ('' at the end of the file)
+        nonlocal pos
+        while True:
+            pos = whitespace.match(buf,pos).end()
+            if pos < len(buf) or not fill():
+                return buf[pos:pos+1]
+
+    def expect(c):
+        nonlocal pos
+        if peek() != c:
+            raise ValueError("Malformed ecg json: expected %r at offset %d of the current chunk" % (c,pos))
+        pos += 1
+
+    def more(i):
+        # read the next chunk, keeping the text from the start of the current value; returns i shifted to the new buffer
+        shift = pos
+        if not fill():
+            raise ValueError("Malformed ecg json: unexpected end of file")
+        return i - shift
+
+    def scan():
+        # end of the value at the current position, found by tracking strings and brackets without decoding it
+        c = peek()
+        i = pos + 1
+        depth = 0
+        in_string = False
+        if c in '{[':
+            depth = 1
+        elif c == '"':
+            in_string = True
+        else:
+            while True:
+                m = scalar_end.search(buf,i)
+                if m is not None:
+                    return m.start()
+                i = more(len(buf))
+        while True:
+            if in_string:
+                m = string_end.search(buf,i)
+                if m is None:
+                    i = more(len(buf))
+                    continue
+                if m.group() == '\\':
+                    if m.end() >= len(buf):
+                        i = more(m.start())
+                        continue
+                    i = m.end() + 1
+                    continue
+                in_string = False
+                i = m.end()
+            else:
+                m = structure.search(buf,i)
+                if m is None:
+                    i = more(len(buf))
+                    continue
+                i = m.end()
+                if m.group() == '"':
+                    in_string = True
+                    continue
+                depth = depth + 1 if m.group() in '{[' else depth - 1
+            if depth == 0:
+                return i
+
+    def value():
+        # a value is complete once it decodes with text left after it (values are always followed by , } ] or :).
+        # a value that runs past the buffer is scanned to its end first, so that it is decoded only once more
+        nonlocal pos
+        peek()
+        try:
+            obj,end = decoder.raw_decode(buf,pos)
+            if end < len(buf) or eof:
+                pos = end
+                return obj
+        except json.JSONDecodeError:
+            if eof:
+                raise
+        scan()
+        obj,pos = decoder.raw_decode(buf,pos)
+        return obj
+
+    def skip():
+        # values outside "reactions" are dropped: containers that fit in the buffer are decoded in one call, larger
+        # ones are walked member by member, so memory is bounded by the buffer rather than by the value
+        nonlocal pos
+        c = peek()
+        if c not in '{[':
+            value()
+            return
+        try:
+            obj,end = decoder.raw_decode(buf,pos)
+            if end < len(buf) or eof:
+                pos = end
+                return
+        except json.JSONDecodeError:
+            if eof:
+                raise
+        for _ in (items() if c == '{' else elements()):
+            skip()
+
+    def elements():
+        expect('[')
+        while True:
+            c = peek()
+            if c == ']':
+                expect(']')
+                return
+            if c == ',':
+                expect(',')
+                continue
+            yield
+
+    def items():
+        # key, value-position pairs of the object starting at the current position
+        expect('{')
+        while True:
+            c = peek()
+            if c == '}':
+                expect('}')
+                return
+            if c == ',':
+                expect(',')
+                continue
+            key = value()
+            expect(':')
+            yield key
+
+    for key in items():
+        if key == "reactions":
+            for rid in items():
+                yield rid, value()
+        else:
+            skip()
+
+def load_ecg_reactions(reactions):
+    # single pass over (rid, reaction) items building the network, the consistent reactions and the thermo of every
+    # pH key ('<pH>pH_100mM'). ids are interned as integer codes and values are collected in typed (fixed-width) arrays
+    cid_codes = {}
+    rids = []
+    network_cid = array('q')
+    network_rn = array('q')
+    network_s = array('q')
+    consistent = array('q')
+    thermo_arrays = {}
+    for i,(rid,v) in enumerate(reactions):
+        rids.append(rid)
         cids = v["left"] + v["right"]
         try: ## This skips all reactions with n stoichiometries
-            stoichs = [-int(i) for i in v["metadata"]["left_stoichiometries"]]+[int(i) for i in v["metadata"]["right_stoichiometries"]]
-            network_list+=list(zip(cids,[rid for _ in range(len(stoichs))],stoichs))
-        except:
-            pass
+            stoichs = [-int(x) for x in v["metadata"]["left_stoichiometries"]]+[int(x) for x in v["metadata"]["right_stoichiometries"]]
+        except (KeyError,TypeError,ValueError):
+            stoichs = []
+        for cid,s in zip(cids,stoichs):
+            network_cid.append(cid_codes.setdefault(cid,len(cid_codes)))
+            network_rn.append(i)
+            network_s.append(s)
         if v["metadata"]["element_conservation"]==True:
-            consistent_rids.append(rid)
-    return pd.DataFrame(network_list,columns=("cid","rn","s")), pd.DataFrame(consistent_rids,columns=["rn"])
+            consistent.append(i)
+        # topology-only exports have no dg data
+        for phkey,dg in (v["metadata"].get("dg") or {}).items():
+            if not phkey.endswith("pH_100mM"):
+                continue
+            t = thermo_arrays.get(phkey[:-len("pH_100mM")])
+            if t is None:
+                t = thermo_arrays[phkey[:-len("pH_100mM")]] = [array('q'),array('d'),array('d'),array('d'),array('d'),array('d'),array('b')]
+            t[0].append(i)
+            for a,x in zip(t[1:6],(dg["standard_dg_prime_value"],dg["standard_dg_prime_error"],dg["p_h"],dg["ionic_strength"],dg["temperature"])):
+                a.append(np.nan if x == None else x)
+            t[6].append(dg["is_uncertain"] == None)
+
+    rids = np.array(rids,dtype=object)
+    cids = np.array(list(cid_codes),dtype=object)
+    network = pd.DataFrame({"cid":cids[np.frombuffer(network_cid,dtype=np.int64)],
+                            "rn":rids[np.frombuffer(network_rn,dtype=np.int64)],
+                            "s":np.frombuffer(network_s,dtype=np.int64)})
+    consistent_rxns = pd.DataFrame(rids[np.frombuffer(consistent,dtype=np.int64)],columns=["rn"])
+    tables = {}
+    for ph,t in thermo_arrays.items():
+        t = [np.frombuffer(x,dtype=np.int64 if x.typecode == 'q' else np.int8 if x.typecode == 'b' else np.float64) for x in t]
+        tables[ph] = pd.DataFrame({"!MiriamID::urn:miriam:kegg.reaction":rids[t[0]],
+                                   "!dG0_prime (kJ/mol)":t[1],
+                                   "!sigma[dG0] (kJ/mol)":t[2],
+                                   "!pH":t[3],
+                                   "!I (mM)":t[4]/1000,
+                                   "!T (Kelvin)":t[5],
+                                   "!Note":pd.Series("uncertainty is too high",index=range(len(t[0]))).where(t[6] > 0)})
+    return network, consistent_rxns, (ThermoStore(tables) if len(tables) else None)
+
+def load_ecg(ecg_json,chunk_size=1<<20):
+    # network, consistent reactions and thermo store of an ecg json file, streamed in one pass
+    with open(ecg_json) as f:
+        return load_ecg_reactions(iter_ecg_reactions(f,chunk_size=chunk_size))
+
+def load_ecg_network(ecg):
+    network, consistent_rxns, _ = load_ecg_reactions(ecg["reactions"].items())
+    return network, consistent_rxns
+
+def record_time(timings,phase,t0):
+    # accumulate the wall time since t0 under phase
+    timings[phase] = timings.get(phase,0) + time.perf_counter() - t0
+    return time.perf_counter()
+
+def intern_ids(ids,codes):
+    # integer codes of ids, adding unseen ids to the codes dict
+    for i in pd.unique(ids):
+        if i not in codes:
+            codes[i] = len(codes)
+    return pd.Series(ids).map(codes).to_numpy()
+
+def load_atlas_reactions(path=None,chunksize=100000,timings=None):
+    # ATLAS reactions ('id;kegg rn;atlas equation;kegg equation;ec;dG;dG error;...'), read in chunks. reaction ids are
+    # rat<id>, as in atlas_network.txt. rows without a complete equation and reactions with non-integer coefficients
+    # are skipped. dG is in kcal/mol in the direction of the equation and is converted to kJ/mol
+    if path is None:
+        path = asset_path + '/atlas/atlas_all_reactions.txt'
+    timings = {} if timings is None else timings
+    cid_codes = {}
+    network = []
+    thermo = []
+    t = time.perf_counter()
+    for chunk in pd.read_csv(path,sep=';',header=None,usecols=[0,3,5,6],names=['id','equation','dg','dg_error'],
+                             chunksize=chunksize,on_bad_lines='skip',dtype={'equation':object}):
+        t = record_time(timings,'read',t)
+        chunk = chunk[chunk['equation'].str.contains('<=>',regex=False,na=False)]
+        sides = chunk['equation'].str.split('<=>',n=1,expand=True)
+        rows = []
+        for side,sign in [(0,-1),(1,1)]:
+            tokens = sides[side].str.split('+').explode()
+            tokens = tokens.str.extract(r'^(?:\(([^)]*)\))?(\S+)$')
+            tokens['id'] = chunk['id'].reindex(tokens.index).to_numpy()
+            tokens['s'] = sign*pd.to_numeric(tokens[0].fillna('1'),errors='coerce')
+            rows.append(tokens)
+        rows = pd.concat(rows,axis=0).sort_index(kind='mergesort')
+        bad = rows['id'][rows['s'].isna() | (rows['s'] % 1 != 0) | rows[1].isna()].unique()
+        rows = rows[~rows['id'].isin(bad)]
+        chunk = chunk[~chunk['id'].isin(bad)]
+        t = record_time(timings,'parse',t)
+        network.append(pd.DataFrame({'cid':intern_ids(rows[1].to_numpy(),cid_codes),
+                                     'rn':rows['id'].to_numpy(dtype=np.int64),
+                                     's':rows['s'].to_numpy(dtype=np.int64)}))
+        thermo.append(chunk[['id','dg','dg_error']])
+        t = record_time(timings,'intern',t)
+
+    network = pd.concat(network,axis=0,ignore_index=True)
+    thermo = pd.concat(thermo,axis=0,ignore_index=True)
+    cids = np.array(list(cid_codes),dtype=object)
+    network = pd.DataFrame({'cid':cids[network['cid'].to_numpy()],
+                            'rn':'rat' + network['rn'].astype(str),
+                            's':network['s']})
+    thermo = pd.DataFrame({'!MiriamID::urn:miriam:kegg.reaction':'rat' + thermo['id'].astype(str),
+                           '!dG0_prime (kJ/mol)':thermo['dg']*4.184,
+                           '!sigma[dG0] (kJ/mol)':thermo['dg_error']*4.184,
+                           '!pH':7.0})
+    record_time(timings,'assemble',t)
+    return network, thermo, timings
+
+def load_atlas_pairs(path=None,chunksize=5000,timings=None):
+    # ATLAS reactant pair network ('reaction_pair,num_rats,rat_list'), read in chunks. every pair becomes a reversible
+    # one substrate/one product reaction named after the pair, and the rat reactions of each pair are returned as a
+    # separate rn/rat table
+    if path is None:
+        path = asset_path + '/atlas/atlas_network.txt'
+    timings = {} if timings is None else timings
+    cid_codes = {}
+    network = []
+    pairs = []
+    t = time.perf_counter()
+    for chunk in pd.read_csv(path,chunksize=chunksize,dtype={'reaction_pair':object,'rat_list':object}):
+        t = record_time(timings,'read',t)
+        chunk = chunk[chunk['reaction_pair'].str.count('_') == 1]
+        cpds = chunk['reaction_pair'].str.split('_',expand=True)
+        rats = chunk['rat_list'].str.split('|').explode().str.extract(r'^rat(\d+)',expand=False).dropna()
+        t = record_time(timings,'parse',t)
+        network.append(pd.DataFrame({'cid':np.concatenate([intern_ids(cpds[0].to_numpy(),cid_codes),intern_ids(cpds[1].to_numpy(),cid_codes)]),
+                                     'rn':np.concatenate([chunk['reaction_pair'].to_numpy()]*2),
+                                     's':np.repeat(np.array([-1,1],dtype=np.int64),len(chunk))}))
+        pairs.append(pd.DataFrame({'rn':chunk['reaction_pair'].reindex(rats.index).to_numpy(),'rat':rats.to_numpy(dtype=np.int64)}))
+        t = record_time(timings,'intern',t)
+
+    network = pd.concat(network,axis=0,ignore_index=True)
+    pairs = pd.concat(pairs,axis=0,ignore_index=True)
+    cids = np.array(list(cid_codes),dtype=object)
+    network['cid'] = cids[network['cid'].to_numpy()]
+    pairs['rat'] = 'rat' + pairs['rat'].astype(str)
+    record_time(timings,'assemble',t)
+    return network, pairs, timings
+
+# standard reaction free energies for several pH values, stored as dense reaction x pH arrays (one per thermo column)
+# so that switching pH is a column selection instead of parsing another table
+class ThermoStore:
+
+    def __init__(self,tables):
+        # tables maps pH values to thermo tables in the layout of the kegg_reactions_CC_ph*.csv files
+        keys = sorted(tables.keys(),key=float)
+        tables = [tables[k].drop_duplicates('!MiriamID::urn:miriam:kegg.reaction') for k in keys]
+        self.ph = np.array([float(k) for k in keys])
+        self.reactions = pd.Index(pd.concat([t['!MiriamID::urn:miriam:kegg.reaction'] for t in tables],axis=0)).unique()
+        self.columns = [c for c in tables[0].columns if c != '!MiriamID::urn:miriam:kegg.reaction']
+        self.dtypes = {c: tables[0][c].dtype for c in self.columns}
+        self.present = np.zeros([len(self.reactions),len(keys)],dtype=bool)
+        self.values = {}
+        for c in self.columns:
+            dtype = float if pd.api.types.is_numeric_dtype(self.dtypes[c]) else object
+            self.values[c] = np.full([len(self.reactions),len(keys)],np.nan,dtype=dtype)
+        for j,t in enumerate(tables):
+            idx = self.reactions.get_indexer(t['!MiriamID::urn:miriam:kegg.reaction'])
+            self.present[idx,j] = True
+            for c in self.columns:
+                self.values[c][idx,j] = t[c].to_numpy()
+        self.dg = self.values['!dG0_prime (kJ/mol)']
+        self.sigma = self.values['!sigma[dG0] (kJ/mol)']
+
+    def ph_index(self,pH):
+        j = np.nonzero(np.isclose(self.ph,float(pH)))[0]
+        if len(j) == 0:
+            raise KeyError(pH)
+        return j[0]
+
+    def thermo(self,pH):
+        # thermo table for a single pH
+        j = self.ph_index(pH)
+        rows = self.present[:,j]
+        thermo = {'!MiriamID::urn:miriam:kegg.reaction': self.reactions[rows]}
+        for c in self.columns:
+            thermo[c] = pd.Series(self.values[c][rows,j]).astype(self.dtypes[c])
+        return pd.DataFrame(thermo)
+
+    def deltaG(self,rns):
+        # rns x pH array of standard free energies, nan for reactions without thermo
+        idx = self.reactions.get_indexer(rns)
+        dg = np.full([len(idx),len(self.ph)],np.nan)
+        dg[idx > -1] = self.dg[idx[idx > -1]]
+        return dg
+
+    def add_aliases(self,rns,source_rns):
+        # store with reactions rns added with the thermo of source_rns (e.g. the generic coenzyme copies of reactions);
+        # the store is shared by shallow copies of the network, so it is not changed in place. existing reactions are kept
+        idx = self.reactions.get_indexer(source_rns)
+        rns = pd.Index(rns)
+        keep = (idx > -1) & ~rns.isin(self.reactions) & ~rns.duplicated()
+        rns,idx = rns[keep],idx[keep]
+        store = copy(self)
+        store.reactions = self.reactions.append(rns)
+        store.present = np.concatenate([self.present,self.present[idx]],axis=0)
+        store.values = {c: np.concatenate([self.values[c],self.values[c][idx]],axis=0) for c in self.columns}
+        store.dg = store.values['!dG0_prime (kJ/mol)']
+        store.sigma = store.values['!sigma[dG0] (kJ/mol)']
+        return store
+
+def load_kegg_thermo_store():
+    tables = {}
+    for f in sorted(os.listdir(asset_path + '/reaction_free_energy')):
+        if f.startswith('kegg_reactions_CC_ph') and f.endswith('.csv'):
+            tables[f[len('kegg_reactions_CC_ph'):-len('.csv')]] = read_asset(asset_path + '/reaction_free_energy/' + f,sep=',')
+    return ThermoStore(tables)
+
+def load_ecg_thermo_store(ecg):
+    return load_ecg_reactions(ecg["reactions"].items())[2]
+
+direction_dtype = pd.CategoricalDtype(['forward','reverse'])
+
+def compact_network(network):
+    # network table with categorical cid, rn and direction columns and the narrowest integer dtype holding s
+    columns = {}
+    for c in ['cid','rn']:
+        if c in network.columns and not isinstance(network[c].dtype,pd.CategoricalDtype):
+            columns[c] = network[c].astype('category')
+    if 'direction' in network.columns and network['direction'].dtype != direction_dtype:
+        columns['direction'] = network['direction'].astype(direction_dtype)
+    if 's' in network.columns and pd.api.types.is_integer_dtype(network['s'].dtype):
+        m = np.abs(network['s'].to_numpy()).max() if len(network) else 0
+        for dtype in [np.int8,np.int16,np.int32,np.int64]:
+            if m <= np.iinfo(dtype).max:
+                break
+        if network['s'].dtype != dtype:
+            columns['s'] = network['s'].astype(dtype)
+    if len(columns) == 0:
+        return network
+    return network.assign(**columns)
+
+# index maps and expansion matrices of an irreversible network; GlobalMetabolicNetwork builds it once and reuses it
+# for every expansion until the network table is replaced
+class CompiledNetwork:
+
+    def __init__(self,rid_to_idx,idx_to_rid,cid_to_idx,idx_to_cid,S):
+        self.rid_to_idx = rid_to_idx
+        self.idx_to_rid = idx_to_rid
+        self.cid_to_idx = cid_to_idx
+        self.idx_to_cid = idx_to_cid
+        self.compound_index = pd.Index([idx_to_cid[i] for i in range(len(idx_to_cid))])
+        rids = [idx_to_rid[i] for i in range(len(idx_to_rid))]
+        self.reaction_index = pd.MultiIndex.from_arrays([[r[0] for r in rids],[r[1] for r in rids]],names=['rn','direction'])
+        self.S = S
+        self.R = csr_matrix(S < 0,dtype=int)
+        self.P = csr_matrix(S > 0,dtype=int)
+        self.b = csr_matrix(self.R.sum(axis=0)).transpose()
+        # compound x reaction incidence (including rows with zero stoichiometry)
+        self.A = csr_matrix((np.ones(S.nnz,dtype=int),S.indices,S.indptr),shape=S.shape)
 
 class GlobalMetabolicNetwork:
     
-    def __init__(self,ecg_json=None):
+    def __init__(self,ecg_json=None,atlas=None):
         # load the data
-        if ecg_json == None:
-            network = pd.read_csv(asset_path + '/KEGG/network_full.csv')
-            cpds = pd.read_csv(asset_path +'/compounds/cpds.txt',sep='\t')
-            thermo = pd.read_csv(asset_path +'/reaction_free_energy/kegg_reactions_CC_ph7.0.csv',sep=',')
+        self.atlas = atlas
+        self.timings = {}
+        if atlas is not None:
+            # atlas is 'reactions' (atlas_all_reactions.txt) or 'pairs' (the reactant pair network of atlas_network.txt)
+            if atlas == 'reactions':
+                network, thermo, self.timings = load_atlas_reactions()
+                self.thermo = thermo
+                self.thermo_store = ThermoStore({'7.0':thermo})
+            elif atlas == 'pairs':
+                network, self.atlas_pairs, self.timings = load_atlas_pairs()
+                self.thermo = None
+                self.thermo_store = None
+            else:
+                raise ValueError("atlas needs to be reactions or pairs")
+            self.network = network
+            self.ecg = None
+            self.compounds = pd.DataFrame(self.network["cid"].unique(),columns=["cid"]) ## Only includes compounds with reactions
+        elif ecg_json == None:
+            # cid and rn load as categoricals, which compact_network keeps as they are
+            network = read_asset(asset_path + '/KEGG/network_full.csv',categorical=True)
+            cpds = read_asset(asset_path +'/compounds/cpds.txt',sep='\t')
+            thermo = read_asset(asset_path +'/reaction_free_energy/kegg_reactions_CC_ph7.0.csv',sep=',')
             self.network = network
             self.thermo = thermo
             self.compounds = cpds ## Includes many compounds without reactions
             self.ecg = None
         else:
-            with open(ecg_json) as f:
-                ecg = json.load(f)
-            network, consistent_rxns = load_ecg_network(ecg)
+            # the json is streamed rather than kept in memory; self.ecg keeps its path
+            network, consistent_rxns, thermo_store = load_ecg(ecg_json)
             self.network = network
-            self.ecg = ecg
+            self.ecg = ecg_json
             self.consistent_rxns = consistent_rxns
             self.compounds = pd.DataFrame(self.network["cid"].unique(),columns=["cid"]) ## Only includes compounds with reactions
 
@@ -135,149 +816,199 @@ class GlobalMetabolicNetwork:
         self.cid_to_idx = None
         self.idx_to_cid = None
         self.S = None
+        # (alias,source) reaction ids registered by addGenericCoenzymes, applied to the thermo store whenever it is loaded
+        self.thermo_aliases = []
+        if atlas is None:
+            self.thermo_store = None if ecg_json == None else thermo_store
         
-    def copy(self):
-        return deepcopy(self)
+    @property
+    def network(self):
+        return self._network
+
+    @network.setter
+    def network(self,network):
+        # every mutator (subnetwork, prune*, convertToIrreversible, addGenericCoenzymes) replaces the network table,
+        # which invalidates the compiled network. the table is kept in compact form (see compact_network)
+        self._network = compact_network(network)
+        self.compiled = None
+
+    def copy(self,deep=True):
+        # a shallow copy shares the network, thermo and compound tables (and the compiled network) with the original.
+        # every method replaces these tables rather than modifying them in place, so the copy only materializes
+        # its own tables once subnetwork, prune*, set_ph, etc. are called on it
+        if deep:
+            return deepcopy(self)
+        return copy(self)
         
     def set_ph(self,pH):
         if ~(type(pH) == str):
             pH = str(pH)
+        store = self.load_thermo_store()
         if self.ecg == None:
             try:
-                thermo = pd.read_csv(asset_path + '/reaction_free_energy/kegg_reactions_CC_ph' + pH + '.csv',sep=',')
-                self.thermo = thermo
+                self.thermo = store.thermo(pH)
             except Exception as error:
                 print('Failed to open pH files (please use 5.0-9.0 in 0.5 increments)')    
         else:
             try:
-                self.thermo = load_ecg_thermo(self.ecg,pH)
+                self.thermo = store.thermo(pH)
             except:
                 raise ValueError("Try another pH, that one appears not to be in the ecg json")
 
-    def load_ecg_thermo(self,ph=9):
-        thermo_list = []
-        for rid,v in self.ecg["reactions"].items():
-            
-            phkey = str(ph)+"pH_100mM"
-            
-            if v["metadata"]["dg"][phkey]["standard_dg_prime_value"] == None:
-                dg = np.nan
-            else:
-                dg = v["metadata"]["dg"][phkey]["standard_dg_prime_value"]
-                
-            if v["metadata"]["dg"][phkey]["standard_dg_prime_error"] == None:
-                dgerror = np.nan
-            else:
-                dgerror = v["metadata"]["dg"][phkey]["standard_dg_prime_error"]
-                
-            if v["metadata"]["dg"][phkey]["is_uncertain"] == None:
-                note = "uncertainty is too high"
-            else:
-                note = np.nan
+    def check_thermo(self):
+        if self.atlas == 'pairs':
+            raise ValueError('ATLAS reactant pair networks have no thermodynamic data')
 
-            thermo_list.append((rid,
-                dg,
-                dgerror,
-                v["metadata"]["dg"][phkey]["p_h"],
-                v["metadata"]["dg"][phkey]["ionic_strength"]/1000,
-                v["metadata"]["dg"][phkey]["temperature"],
-                note)) 
+    def load_thermo_store(self):
+        # thermo for every available pH, loaded once
+        self.check_thermo()
+        if self.thermo_store is None:
+            if self.ecg == None:
+                self.thermo_store = load_kegg_thermo_store()
+            else:
+                self.thermo_store = load_ecg(self.ecg)[2] if isinstance(self.ecg,str) else load_ecg_thermo_store(self.ecg)
+            for rns,source_rns in self.thermo_aliases:
+                if self.thermo_store is not None:
+                    self.thermo_store = self.thermo_store.add_aliases(rns,source_rns)
+        return self.thermo_store
 
-        return pd.DataFrame(thermo_list, columns = ("!MiriamID::urn:miriam:kegg.reaction","!dG0_prime (kJ/mol)","!sigma[dG0] (kJ/mol)","!pH","!I (mM)","!T (Kelvin)","!Note"))         
+    def load_ecg_thermo(self,ph=9):
+        return self.load_thermo_store().thermo(ph)
 
     
     def pruneInconsistentReactions(self):
         # remove reactions with qualitatively different sets of elements in reactions and products
-        if self.ecg==None:
-            consistent = pd.read_csv(asset_path + '/reaction_sets/reactions_consistent.csv')
+        if self.atlas is not None:
+            # ATLAS reactions are generated from balanced reaction rules
+            return
+        elif self.ecg==None:
+            consistent = read_asset(asset_path + '/reaction_sets/reactions_consistent.csv')
             self.network = self.network[self.network.rn.isin(consistent.rn.tolist())]
         else:
             self.network = self.network[self.network.rn.isin(self.consistent_rxns.rn.tolist())]
         
     def pruneUnbalancedReactions(self):
         # only keep reactions that are elementally balanced
-        balanced = pd.read_csv(asset_path + '/reaction_sets/reactions_balanced.csv')
+        if self.atlas is not None:
+            return
+        balanced = read_asset(asset_path + '/reaction_sets/reactions_balanced.csv')
         self.network = self.network[self.network.rn.isin(balanced.rn.tolist())]
         
     def subnetwork(self,rxns):
         # only keep reactions that are in list
         self.network = self.network[self.network.rn.isin(rxns)]
         
-    def addGenericCoenzymes(self):
-        replace_metabolites = {'C00003': 'Generic_oxidant', 'C00004': 'Generic_reductant', 'C00006': 'Generic_oxidant',  'C00005': 'Generic_reductant','C00016': 'Generic_oxidant','C01352':'Generic_reductant'}
-        coenzyme_pairs = {}
-        coenzyme_pairs['NAD'] = ['C00003','C00004']
-        coenzyme_pairs['NADP'] = ['C00006','C00005']
-        coenzyme_pairs['FAD'] = ['C00016','C01352']
-        coenzyme_pairs = pd.DataFrame(coenzyme_pairs).T.reset_index()
-        coenzyme_pairs.columns = ['id','oxidant','reductant']
-        # create reactions copies with coenzyme pairs
-        new_rxns = []
-        new_thermo = [];
-        for idx,rxn in self.network.groupby('rn'):
-            z = any([isRxnCoenzymeCoupled(rxn,row.oxidant,row.reductant) for x,row in coenzyme_pairs.iterrows()])
-            if z:
-                new_rxn = rxn.replace(replace_metabolites).groupby(['cid','rn']).sum().reset_index()
-                new_rxn['rn'] = new_rxn['rn'] = idx + '_G'
-                new_rxns.append(new_rxn)
-                t = self.thermo[self.thermo['!MiriamID::urn:miriam:kegg.reaction'] == idx].replace({idx:  idx + '_G'})
-                new_thermo.append(t)
-
-        new_rxns = pd.concat(new_rxns,axis=0)
-        new_thermo = pd.concat(new_thermo,axis=0)
+    def addGenericCoenzymes(self,coenzyme_pairs=None):
+        # coenzyme_pairs is a table with id, oxidant and reductant columns (or a dict of id: [oxidant,reductant])
+        self.check_thermo()
+        if coenzyme_pairs is None:
+            coenzyme_pairs = {}
+            coenzyme_pairs['NAD'] = ['C00003','C00004']
+            coenzyme_pairs['NADP'] = ['C00006','C00005']
+            coenzyme_pairs['FAD'] = ['C00016','C01352']
+        if isinstance(coenzyme_pairs,dict):
+            coenzyme_pairs = pd.DataFrame(coenzyme_pairs).T.reset_index()
+            coenzyme_pairs.columns = ['id','oxidant','reductant']
+        replace_metabolites = dict([(x,'Generic_oxidant') for x in coenzyme_pairs.oxidant] + [(x,'Generic_reductant') for x in coenzyme_pairs.reductant])
+
+        # a reaction is coupled to a pair if it has more than one entry of the pair and their stoichiometries cancel
+        pair_cids = pd.concat([coenzyme_pairs[['id','oxidant']].rename(columns={'oxidant':'cid'}),
+                               coenzyme_pairs[['id','reductant']].rename(columns={'reductant':'cid'})],axis=0).drop_duplicates()
+        g = self.network[['rn','cid','s']].merge(pair_cids,on='cid')
+        g = g.groupby(['rn','id'],observed=True)['s'].agg(['size','sum'])
+        coupled = g[(g['size'] > 1) & (g['sum'] == 0)].index.get_level_values('rn').unique()
+        if len(coupled) == 0:
+            return
+
+        # create reactions copies with generic coenzymes
+        new_rxns = self.network[self.network.rn.isin(coupled)]
+        new_rxns = new_rxns.assign(rn=new_rxns['rn'].astype(object),cid=new_rxns['cid'].astype(object).replace(replace_metabolites),s=new_rxns['s'].astype(int))
+        new_rxns = new_rxns.groupby(['rn','cid'] + (['direction'] if 'direction' in new_rxns.columns else []),observed=True).sum().reset_index()
+        new_rxns = new_rxns[['cid','rn'] + [c for c in new_rxns.columns if c not in ['cid','rn']]]
+        new_rxns['rn'] = new_rxns['rn'] + '_G'
+
+        new_thermo = self.thermo[self.thermo['!MiriamID::urn:miriam:kegg.reaction'].isin(coupled)]
+        new_thermo = new_thermo.sort_values('!MiriamID::urn:miriam:kegg.reaction',kind='mergesort').copy()
+        new_thermo['!MiriamID::urn:miriam:kegg.reaction'] = new_thermo['!MiriamID::urn:miriam:kegg.reaction'] + '_G'
 
         self.network = pd.concat([self.network,new_rxns],axis=0)
         self.thermo = pd.concat([self.thermo,new_thermo],axis=0)
+        # the aliases are also applied to a store that is loaded later (see load_thermo_store)
+        aliases = ([rn + '_G' for rn in coupled],list(coupled))
+        self.thermo_aliases = self.thermo_aliases + [aliases]
+        if self.thermo_store is not None:
+            self.thermo_store = self.thermo_store.add_aliases(*aliases)
 
     
     def convertToIrreversible(self):
-        nf = self.network.copy()
-        nb = self.network.copy()
-        nf['direction'] = 'forward'
-        nb['direction'] = 'reverse'
-        nb['s'] = -nb['s']
-        net = pd.concat([nf,nb],axis=0)
-        net = net.set_index(['cid','rn','direction']).reset_index()
-        self.network = net
+        # forward rows followed by reverse rows (with negated stoichiometries), built from the column arrays
+        network = self.network
+        n = len(network)
+        net = {'cid':None,'rn':None,'direction':pd.Categorical.from_codes(np.repeat(np.array([0,1],dtype=np.int8),n),dtype=direction_dtype)}
+        for c in network.columns:
+            if c == 'direction':
+                continue
+            values = network[c].array
+            if c == 's':
+                values = np.concatenate([values,-values])
+            elif isinstance(values,pd.Categorical):
+                values = pd.Categorical.from_codes(np.tile(values.codes,2),dtype=values.dtype)
+            else:
+                values = np.tile(np.asarray(values),2)
+            net[c] = values
+        self.network = pd.DataFrame(net)
     
     def setMetaboliteBounds(self,ub = 1e-1,lb = 1e-6): 
-        
-        self.network['ub'] = ub
-        self.network['lb'] = lb
+        # assign a new table so that shallow copies sharing the network are not modified;
+        # bounds do not change the compiled network, so it is kept
+        self._network = self.network.assign(ub = ub,lb = lb)
       
-    def pruneThermodynamicallyInfeasibleReactions(self,keepnan = False):
+    def concentration_term(self):
+        # substrates at their upper bound and products at their lower bound, excluding fixed metabolites (s*log(bound) per row)
         fixed_mets = ['C00001','C00080']
+        network = self.network
+        s = network['s'].where(~network['cid'].isin(fixed_mets),0)
+        logc = np.where(s < 0,np.log(network['ub']),np.log(network['lb']))
+        return pd.Series(np.where(s != 0,logc*s,0.0),index=network.index)
 
+    def pruneThermodynamicallyInfeasibleReactions(self,keepnan = False):
+        self.check_thermo()
+        t = time.perf_counter()
         RT = 0.008309424 * (273.15+self.temperature)
-        rns  = []
-        dirs = []
-        dgs = []
-        for (rn,direction), dff in self.network.groupby(['rn','direction']):
-            effective_deltaG = np.nan
-            if rn in self.thermo['!MiriamID::urn:miriam:kegg.reaction'].tolist():
-                deltaG = self.thermo[self.thermo['!MiriamID::urn:miriam:kegg.reaction'] == rn]['!dG0_prime (kJ/mol)'].values[0]
-                if direction == 'reverse':
-                    deltaG = -1*deltaG
-
-                dff = dff[~dff['cid'].isin(fixed_mets)]
-                subs = dff[dff['s'] < 0]
-                prods = dff[dff['s'] > 0];
-                k = np.dot(subs['ub'].apply(np.log),subs['s']) + np.dot(prods['lb'].apply(np.log),prods['s'])
-
-                effective_deltaG = RT*k + deltaG
-
-            dgs.append(effective_deltaG)
-            dirs.append(direction)
-            rns.append(rn)
+        network = self.network
+        # standard free energy of each row's reaction (first thermo entry per reaction), sign flipped for reverse reactions
+        thermo = self.thermo.drop_duplicates('!MiriamID::urn:miriam:kegg.reaction').set_index('!MiriamID::urn:miriam:kegg.reaction')
+        deltaG = network['rn'].map(thermo['!dG0_prime (kJ/mol)']).astype(float)
+        deltaG = deltaG.where(network['direction'] != 'reverse',-deltaG)
 
-        res = pd.DataFrame({'rn':rns,'direction':dirs,'effDeltaG':dgs})
-        if ~keepnan:
-            res = res.dropna()
-        
-        #res = res[res['effDeltaG'] < 0].set_index(['rn','direction'])
-        res = res[~(res['effDeltaG'] > 0)].set_index(['rn','direction'])
-        res = res.drop('effDeltaG',axis=1)
-        self.network = res.join(self.network.set_index(['rn','direction'])).reset_index()
+        k = self.concentration_term().groupby([network['rn'],network['direction']],observed=True).transform('sum')
+        effective_deltaG = RT*k + deltaG
+
+        keep = ~(effective_deltaG > 0)
+        if not keepnan:
+            keep = keep & effective_deltaG.notna()
+
+        #keep = effective_deltaG < 0
+        network = network[keep]
+        columns = ['rn','direction'] + [c for c in network.columns if c not in ['rn','direction']]
+        self.network = network[columns].sort_values(['rn','direction'],kind='mergesort').reset_index(drop=True)
+        timings = dict(self.timings)
+        record_time(timings,'prune',t)
+        self.timings = timings
+
+    def thermodynamicFeasibility(self,keepnan = False):
+        # feasibility of every (rn,direction) at every pH of the thermo store, in one vectorized pass;
+        # column pH of the result matches pruneThermodynamicallyInfeasibleReactions after set_ph(pH)
+        store = self.load_thermo_store()
+        RT = 0.008309424 * (273.15+self.temperature)
+        network = self.network
+        k = self.concentration_term().groupby([network['rn'],network['direction']],observed=True).sum()
+        sign = np.where(k.index.get_level_values('direction') == 'reverse',-1,1)
+        effective_deltaG = RT*k.values[:,None] + sign[:,None]*store.deltaG(k.index.get_level_values('rn'))
+        feasible = ~(effective_deltaG > 0)
+        if not keepnan:
+            feasible = feasible & ~np.isnan(effective_deltaG)
+        return pd.DataFrame(feasible,index=k.index,columns=store.ph)
     
     def initialize_metabolite_vector(self,seedSet):
         if seedSet is None:
@@ -289,62 +1020,127 @@ class GlobalMetabolicNetwork:
             return x0
 
     def create_reaction_dicts(self):
-        rids = set(zip(self.network["rn"],self.network["direction"]))
-        rid_to_idx = dict()
-        idx_to_rid = dict()
-        for v, k in enumerate(rids):
-            rid_to_idx[k] = v
-            idx_to_rid[v] = k
+        rids = pd.MultiIndex.from_arrays([self.network["rn"],self.network["direction"]]).unique()
+        idx_to_rid = dict(enumerate(rids))
+        rid_to_idx = {k: v for v, k in idx_to_rid.items()}
         
         return rid_to_idx, idx_to_rid
 
     def create_compound_dicts(self):
-        cids = set(self.network["cid"])
-        cid_to_idx = dict()
-        idx_to_cid = dict()
-        for v, k in enumerate(cids):
-            cid_to_idx[k] = v
-            idx_to_cid[v] = k
+        cids = self.network["cid"].unique()
+        idx_to_cid = dict(enumerate(cids))
+        cid_to_idx = {k: v for v, k in idx_to_cid.items()}
         
         return cid_to_idx, idx_to_cid
 
     def create_S_from_irreversible_network(self):
-        
-        S = np.zeros([len(self.cid_to_idx),len(self.rid_to_idx)])
-            
-        for c,r,d,s in zip(self.network["cid"],self.network["rn"],self.network["direction"],self.network["s"]):
-            S[self.cid_to_idx[c],self.rid_to_idx[(r,d)]] = s
+        # build S as a sparse matrix from the integer codes of cid and (rn,direction), without a dense intermediate;
+        # repeated (cid,rn,direction) rows keep the last stoichiometry
+        network = self.network.drop_duplicates(['cid','rn','direction'],keep='last')
+        cids = pd.Index([self.idx_to_cid[i] for i in range(len(self.idx_to_cid))])
+        rids = [self.idx_to_rid[i] for i in range(len(self.idx_to_rid))]
+        rids = pd.MultiIndex.from_arrays([[r[0] for r in rids],[r[1] for r in rids]],names=['rn','direction'])
+        rows = cids.get_indexer(network["cid"])
+        cols = rids.get_indexer(pd.MultiIndex.from_arrays([network["rn"],network["direction"]]))
+        S = coo_matrix((network["s"].to_numpy(dtype=np.int64),(rows,cols)),shape=(len(cids),len(rids))).tocsr()
 
         return S
         
-    def expand(self,seedSet,algorithm='naive'):
-        # constructre network from skinny table and create matricies for NE algorithm
-        # if (self.rid_to_idx is None) or (self.idx_to_rid is None):
-        self.rid_to_idx, self.idx_to_rid = self.create_reaction_dicts()
-        # if (self.cid_to_idx is None) or (self.idx_to_cid is None):
-        self.cid_to_idx, self.idx_to_cid = self.create_compound_dicts()
-        # if self.S is None:
-        self.S = self.create_S_from_irreversible_network()
-        x0 = self.initialize_metabolite_vector(seedSet)
-        R = (self.S < 0)*1
-        P = (self.S > 0)*1
-        b = sum(R)
+    def compile(self):
+        # constructre network from skinny table and create matricies for NE algorithm, reusing them until the network changes
+        if self.compiled is None:
+            timings = dict(self.timings)
+            t = time.perf_counter()
+            self.rid_to_idx, self.idx_to_rid = self.create_reaction_dicts()
+            self.cid_to_idx, self.idx_to_cid = self.create_compound_dicts()
+            t = record_time(timings,'index',t)
+            self.S = self.create_S_from_irreversible_network()
+            t = record_time(timings,'stoichiometry',t)
+            self.compiled = CompiledNetwork(self.rid_to_idx,self.idx_to_rid,self.cid_to_idx,self.idx_to_cid,self.S)
+            record_time(timings,'matrices',t)
+            self.timings = timings
+        else:
+            self.rid_to_idx, self.idx_to_rid = self.compiled.rid_to_idx, self.compiled.idx_to_rid
+            self.cid_to_idx, self.idx_to_cid = self.compiled.cid_to_idx, self.compiled.idx_to_cid
+            self.S = self.compiled.S
+        return self.compiled
+
+    def create_expansion_matrices(self):
+        compiled = self.compile()
+        return compiled.R,compiled.P,compiled.b
 
-        # sparsefy data
-        R = csr_matrix(R)
-        P = csr_matrix(P)
-        b = csr_matrix(b)
-        b = b.transpose()
+    def initialize_reaction_vector(self,rxns):
+        # reactions can be given as (rn,direction) tuples, or as reaction ids to select both directions
+        reaction_index = self.compile().reaction_index
+        rxns = list(rxns)
+        y0 = reaction_index.get_level_values('rn').isin([r for r in rxns if not isinstance(r,tuple)])
+        idx = reaction_index.get_indexer([r for r in rxns if isinstance(r,tuple)])
+        y0[idx[idx > -1]] = True
+        return y0.astype(int)
 
+    def reaction_mask(self,rxns):
+        # boolean mask over the compiled reactions, from a mask or a list of reaction ids / (rn,direction) tuples
+        if isinstance(rxns,np.ndarray) and (rxns.dtype == bool):
+            return rxns
+        return self.initialize_reaction_vector(rxns) > 0
+
+    def expand(self,seedSet,algorithm='naive',prior=None,new_reactions=None,reactions=None):
+        # prior is an optional (compounds,reactions) result of a previous expansion on a subset of this network;
+        # when given, expansion is warm-started from its compounds (the reactions they enable follow). new_reactions restricts propagation to the given
+        # reactions, which is only valid when prior is a fixed point.
+        # reactions optionally restricts which reactions may fire (a boolean mask or a list of ids), which gives the same
+        # result as expanding subnetwork(reactions) without copying or filtering the network table
+        if len(self.network) == 0:
+            return [],[]
+        R,P,b = self.create_expansion_matrices()
+        t = time.perf_counter()
+        if prior is not None:
+            seedSet = set(seedSet) | set(prior[0])
+        x0 = self.initialize_metabolite_vector(seedSet)
+        if reactions is not None:
+            enabled = self.reaction_mask(reactions)
+            # compounds that only take part in disabled reactions are not in the subnetwork
+            x0 = x0 * (self.compiled.A.dot(enabled.astype(int)) > 0)
+            R,P,b = R[:,enabled],P[:,enabled],b[enabled]
         x0 = csr_matrix(x0)
         x0 = x0.transpose()
-        if algorithm.lower() == 'naive':
+
+        if prior is not None:
+            if new_reactions is not None:
+                new_reactions = self.initialize_reaction_vector(new_reactions)
+                if reactions is not None:
+                    new_reactions = new_reactions[enabled]
+                new_reactions = np.nonzero(new_reactions)[0]
+            x,y = netExp_warmstart(R,P,x0,b,new_reactions)
+        elif algorithm.lower() == 'naive':
             x,y = netExp(R,P,x0,b)
         elif algorithm.lower() == 'cr':
             x,y = netExp_cr(R,P,x0,b)
+        elif algorithm.lower() == 'worklist':
+            x,y = netExp_worklist(R,P,x0,b)
+        elif algorithm.lower() == 'bits':
+            x,y = netExp_bits(R,P,x0,b)
         else:
-            raise ValueError('algorithm needs to be naive (compound stopping criteria) or cr (reaction/compound stopping criteria)')
-        
+            raise ValueError('algorithm needs to be naive (compound stopping criteria), cr (reaction/compound stopping criteria), worklist (event-driven) or bits (bit-packed)')
+
+        if reactions is not None:
+            # map the fired reactions back to the indices of the compiled network
+            y_full = np.zeros(len(enabled),dtype=int)
+            y_full[enabled] = y.toarray().ravel()
+            y = csr_matrix(y_full).transpose()
+        timings = dict(self.timings)
+        record_time(timings,'expand',t)
+        self.timings = timings
+        return self.expansion_result(x,y)
+
+    def expand_trace(self,seedSet):
+        # run network expansion and return the iteration at which each compound first appears and each reaction first fires
+        R,P,b = self.create_expansion_matrices()
+        x0 = csr_matrix(self.initialize_metabolite_vector(seedSet)).transpose()
+        compound_iter,reaction_iter = netExp_trace(R,P,x0,b,compact=True)
+        return parse_compound_iter(compound_iter,self.idx_to_cid),parse_reaction_iter(reaction_iter,self.idx_to_rid)
+
+    def expansion_result(self,x,y):
         # convert to list of metabolite ids and reaction ids
         if x.toarray().sum() > 0:
             cidx = np.nonzero(x.toarray().T[0])[0]
@@ -360,3 +1156,203 @@ class GlobalMetabolicNetwork:
             
         return compounds,reactions
 
+    def expand_many(self,seedSets,batch_size=256,return_matrix=False):
+        # run network expansion for many seed sets at once, building the network matrices only once
+        R,P,b = self.create_expansion_matrices()
+        X0 = np.array([self.initialize_metabolite_vector(seedSet) for seedSet in seedSets]).reshape(len(seedSets),len(self.cid_to_idx)).T
+        X = []
+        Y = []
+        for i in range(0,len(seedSets),batch_size):
+            x,y = netExp_many(R,P,X0[:,i:i+batch_size],b)
+            X.append(x)
+            Y.append(y)
+        X = hstack(X,format='csc') if len(X) > 0 else csc_matrix((len(self.cid_to_idx),0),dtype=bool)
+        Y = hstack(Y,format='csc') if len(Y) > 0 else csc_matrix((len(self.rid_to_idx),0),dtype=bool)
+        if return_matrix:
+            # compounds x seed sets and reactions x seed sets membership, indexed by idx_to_cid and idx_to_rid
+            return X,Y
+
+        results = []
+        for j in range(X.shape[1]):
+            compounds = [self.idx_to_cid[i] for i in X[:,j].indices]
+            reactions = [self.idx_to_rid[i] for i in Y[:,j].indices]
+            results.append((compounds,reactions))
+        return results
+
+    def conditionGrid(self,seedSet,ph=None,temperature=None,bounds=None,keepnan=False,return_matrix=False):
+        # scope of seedSet for every combination of pH (default: every pH of the thermo store), temperature and
+        # (ub,lb) metabolite bounds. this is equivalent to set_ph, setMetaboliteBounds, pruneThermodynamicallyInfeasibleReactions
+        # and expand for each condition, but effective free energies of all conditions are computed as one broadcasted
+        # array and conditions with identical feasible reaction sets are expanded only once. the store carries the thermo
+        # of generic coenzyme reactions however it was loaded (see load_thermo_store)
+        store = self.load_thermo_store()
+        ph = store.ph if ph is None else np.atleast_1d(np.asarray(ph,dtype=float))
+        temperature = np.atleast_1d(np.asarray(self.temperature if temperature is None else temperature,dtype=float))
+        bounds = [(1e-1,1e-6)] if bounds is None else list(bounds)
+        ub = np.array([x[0] for x in bounds],dtype=float)
+        lb = np.array([x[1] for x in bounds],dtype=float)
+
+        # with uniform bounds, the concentration term of a reaction is log(ub)*(substrate stoichiometry) + log(lb)*(product stoichiometry)
+        compiled = self.compile()
+        network = self.network
+        fixed_mets = ['C00001','C00080']
+        s = network['s'].where(~network['cid'].isin(fixed_mets),0)
+        keys = [network['rn'],network['direction']]
+        n_subs = s.where(s < 0,0).groupby(keys,observed=True).sum().reindex(compiled.reaction_index).values
+        n_prods = s.where(s > 0,0).groupby(keys,observed=True).sum().reindex(compiled.reaction_index).values
+        sign = np.where(compiled.reaction_index.get_level_values('direction') == 'reverse',-1,1)
+        deltaG = sign[:,None]*store.deltaG(compiled.reaction_index.get_level_values('rn'))[:,[store.ph_index(p) for p in ph]]
+
+        # reactions x pH x temperature x bounds
+        RT = 0.008309424 * (273.15+temperature)
+        k = n_subs[:,None]*np.log(ub)[None,:] + n_prods[:,None]*np.log(lb)[None,:]
+        effective_deltaG = RT[None,None,:,None]*k[:,None,None,:] + deltaG[:,:,None,None]
+        feasible = ~(effective_deltaG > 0)
+        if not keepnan:
+            feasible = feasible & ~np.isnan(effective_deltaG)
+        feasible = feasible.reshape(len(sign),-1)
+
+        # expand each distinct feasible reaction set once; seeds outside the feasible reactions are not in the network
+        masks,scope = np.unique(feasible.T,axis=0,return_inverse=True)
+        masks = masks.T
+        x0 = self.initialize_metabolite_vector(seedSet) > 0
+        X0 = x0[:,None] & (compiled.A.dot(masks.astype(int)) > 0)
+        X,Y = netExp_many(compiled.R,compiled.P,X0,compiled.b,enabled=masks)
+
+        conditions = pd.MultiIndex.from_product([ph,temperature,range(len(bounds))],names=['ph','temperature','bounds']).to_frame(index=False)
+        conditions['ub'] = ub[conditions['bounds']]
+        conditions['lb'] = lb[conditions['bounds']]
+        conditions['scope'] = scope.ravel()
+        conditions['n_compounds'] = np.asarray(X.sum(axis=0)).ravel()[conditions['scope']]
+        conditions['n_reactions'] = np.asarray(Y.sum(axis=0)).ravel()[conditions['scope']]
+        conditions = conditions.drop('bounds',axis=1)
+        if return_matrix:
+            # compounds x scopes and reactions x scopes membership, indexed by idx_to_cid and idx_to_rid
+            return conditions,X,Y
+
+        compounds = [[self.idx_to_cid[i] for i in X[:,j].indices] for j in range(X.shape[1])]
+        reactions = [[self.idx_to_rid[i] for i in Y[:,j].indices] for j in range(Y.shape[1])]
+        conditions['compounds'] = [compounds[j] for j in conditions['scope']]
+        conditions['reactions'] = [reactions[j] for j in conditions['scope']]
+        return conditions
+
+
+# decremental network expansion: retract reactions (or compounds) from a computed scope without re-running expansion.
+# each compound keeps a count of the fired reactions that first produced it (its derivation record), so a knockout
+# only removes compounds whose supporting reactions are all lost, and then re-derives the ones that have an
+# alternative route (delete and re-derive), which gives the same result as netExp on the reduced network
+class DecrementalExpansion:
+
+    def __init__(self,metabolism,seedSet):
+        R,P,b = metabolism.create_expansion_matrices()
+        self.rid_to_idx = metabolism.rid_to_idx
+        self.idx_to_rid = metabolism.idx_to_rid
+        self.cid_to_idx = metabolism.cid_to_idx
+        self.idx_to_cid = metabolism.idx_to_cid
+        self.R = csr_matrix(R)
+        self.P = csr_matrix(P)
+        self.Pt = csr_matrix(P.transpose())
+        # compound x reaction incidence, used to find compounds that drop out of the network
+        self.A = metabolism.compiled.A
+        x0 = metabolism.initialize_metabolite_vector(seedSet)
+        self.seeds = x0 > 0
+        self.compound_iter,self.reaction_iter,self.unmet = netExp_levels(R,P,csr_matrix(x0).transpose(),b)
+        self.x = self.compound_iter > -1
+        self.y = self.reaction_iter > -1
+
+        # support of a compound: fired reactions producing it at the iteration it first appears
+        Pc = self.P.tocoo()
+        supporting = self.y[Pc.col] & (self.reaction_iter[Pc.col] == self.compound_iter[Pc.row])
+        self.support = np.bincount(Pc.row[supporting],minlength=len(self.x))
+
+    def reaction_indices(self,rxns):
+        # reactions can be given as (rn,direction) tuples, or as reaction ids to select both directions
+        rxns = set(rxns)
+        return np.array(sorted(v for k,v in self.rid_to_idx.items() if (k in rxns) or (k[0] in rxns)),dtype=int)
+
+    def compound_indices(self,cpds):
+        return np.array(sorted(self.cid_to_idx[c] for c in set(cpds) if c in self.cid_to_idx),dtype=int)
+
+    def scope(self):
+        compounds = [self.idx_to_cid[i] for i in np.nonzero(self.x)[0]]
+        reactions = [self.idx_to_rid[i] for i in np.nonzero(self.y)[0]]
+        return compounds,reactions
+
+    def retract(self,reactions=None,compounds=None):
+        # returns boolean compound and reaction vectors of the scope after removing the reaction indices in reactions
+        # and the compound indices in compounds (which also removes every reaction they take part in)
+        n_reactions = len(self.y)
+        x = self.x.copy()
+        y = self.y.copy()
+        unmet = self.unmet.copy()
+        support = self.support.copy()
+        seeds = self.seeds.copy()
+        removed_compounds = np.asarray([] if compounds is None else compounds,dtype=int)
+        removed_reactions = np.asarray([] if reactions is None else reactions,dtype=int)
+        removed_reactions = np.union1d(removed_reactions,self.A[removed_compounds].indices).astype(int)
+        enabled = np.ones(n_reactions,dtype=bool)
+        enabled[removed_reactions] = False
+
+        # compounds that are no longer part of any reaction leave the network (and the seed set)
+        touched = np.unique(self.A[:,removed_reactions].tocoo().row)
+        gone = touched[self.A[touched].dot(enabled.astype(int)) == 0]
+        seeds[gone] = False
+        if not seeds.any():
+            # like netExp, nothing is reached when no seed is in the network
+            return np.zeros(len(x),dtype=bool),np.zeros(n_reactions,dtype=bool)
+
+        # over-delete every compound that loses all of its supporting reactions, and every reaction consuming it
+        deleted = [gone]
+        lost = gone[x[gone]]
+        unfired = removed_reactions[y[removed_reactions]]
+        y[unfired] = False
+        while (len(unfired) > 0) | (len(lost) > 0):
+            products = self.Pt[unfired]
+            rows = np.repeat(unfired,np.diff(products.indptr))
+            products = products.indices[self.reaction_iter[rows] == self.compound_iter[products.indices]]
+            np.subtract.at(support,products,1)
+            candidates = np.unique(products)
+            lost = np.union1d(lost,candidates[(support[candidates] <= 0) & x[candidates] & ~seeds[candidates]]).astype(int)
+            x[lost] = False
+            deleted.append(lost)
+            consumers = self.R[lost].indices
+            np.add.at(unmet,consumers,1)
+            unfired = np.unique(consumers[y[consumers]])
+            y[unfired] = False
+            lost = np.array([],dtype=int)
+
+        # re-derive deleted compounds that are still produced by a remaining reaction
+        deleted = np.setdiff1d(np.concatenate(deleted),gone).astype(int)
+        frontier = deleted[self.P[deleted].dot(y.astype(int)) > 0]
+        worklist_propagate(self.R,self.Pt,x,y,unmet,frontier,enabled=enabled)
+        return x,y
+
+    def knockout(self,reactions=None,compounds=None):
+        # scope after removing reactions (ids or (rn,direction) tuples) and compounds, in the same format as expand
+        ridx = None if reactions is None else self.reaction_indices(reactions)
+        cidx = None if compounds is None else self.compound_indices(compounds)
+        x,y = self.retract(ridx,cidx)
+        compounds = [self.idx_to_cid[i] for i in np.nonzero(x)[0]]
+        reactions = [self.idx_to_rid[i] for i in np.nonzero(y)[0]]
+        return compounds,reactions
+
+    def knockout_scan(self,reactions=None):
+        # knock out each reaction (default: every reaction in the scope) one at a time, and count what is lost
+        if reactions is None:
+            ridx = np.nonzero(self.y)[0]
+        else:
+            ridx = self.reaction_indices(reactions)
+        n_compounds = self.x.sum()
+        n_reactions = self.y.sum()
+        rns = []
+        dirs = []
+        compounds_lost = []
+        reactions_lost = []
+        for i in ridx:
+            x,y = self.retract([i])
+            rn,direction = self.idx_to_rid[i]
+            rns.append(rn)
+            dirs.append(direction)
+            compounds_lost.append(n_compounds - x.sum())
+            reactions_lost.append(n_reactions - y.sum())
+        return pd.DataFrame({'rn':rns,'direction':dirs,'compounds_lost':compounds_lost,'reactions_lost':reactions_lost})